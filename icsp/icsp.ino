@@ -3,6 +3,26 @@
 #define HV 19
 #define VDD 15
 
+// First address of the configuration memory (User IDs, Config Words)
+#define ICSP_CONFIG_BASE 0x8000
+
+// Capability bits reported by the 'v' command
+#define CAP_CONFIG_BLOCK 0x01
+#define CAP_CRC_WRITE 0x02
+#define CAP_SET_BAUD  0x04
+#define CAP_STREAM_WRITE 0x08
+#define FIRMWARE_CAPS (CAP_CONFIG_BLOCK | CAP_CRC_WRITE | CAP_SET_BAUD | CAP_STREAM_WRITE)
+
+// 'S' streams: rows per CRC-32 ack, and the row address that ends the stream
+#define STREAM_ACK_ROWS 4
+#define STREAM_END 0xFFFF
+
+// Baud rate every session starts at, restored on exit after a 'B' switch
+#define BAUD_DEFAULT 115200
+// Range of baud rates accepted by the 'B' command
+#define BAUD_MIN 9600
+#define BAUD_MAX 5000000
+
 // Delay configuration for ICSP
 #define ICSP_DELAY_CLK 2
 #define ICSP_DELAY_DLY 10
@@ -17,6 +37,10 @@ static char startup_seq[] = {'M', 'C', 'H', 'P'};
 void command(char cmd);
 void start_programming(void);
 void read_words(void);
+bool receive_words(int *address, int *wLength);
+void program_words(int address, int wLength);
+uint16_t crc16_update(uint16_t crc, uint8_t data);
+uint32_t crc32_update(uint32_t crc, uint8_t data);
 
 void icsp_pins_out(void);
 void icsp_pins_low(void);
@@ -26,7 +50,9 @@ void icsp_pins_low(void);
 #define CLK_CYCLE() CLK_HIGH(); CLK_LOW()
 
 void setup() {
-  Serial.begin(115200);
+  // The host pipelines up to 8 row writes + read-backs (~600 bytes) before reading replies
+  Serial.setRxBufferSize(1024);
+  Serial.begin(BAUD_DEFAULT);
   Serial.setTimeout(5000); // 5sec timeout
 
   while (!Serial) {}
@@ -67,6 +93,23 @@ void command(char cmd) {
     case 'w': // Write words
       write_words();
     break;
+
+    case 'W': // Write words, reply with the CRC of the read-back
+      write_words_crc();
+    break;
+
+    case 'v': // Report capabilities
+      Serial.write('K');
+      Serial.write(FIRMWARE_CAPS);
+    break;
+
+    case 'B': // Switch baud rate
+      set_baud();
+    break;
+
+    case 'S': // Stream rows
+      stream_write();
+    break;
     
     case 'e': // Erase row
       erase_row();
@@ -119,6 +162,10 @@ void exit_programming(void) {
 
   // Tristate pins
   icsp_pins_in();
+
+  // The host always opens the next session at the default rate
+  Serial.flush();
+  Serial.updateBaudRate(BAUD_DEFAULT);
 }
 
 // This gets called before receiving any of the arugments
@@ -152,33 +199,168 @@ void read_words(void) {
 }
 
 void write_words(void) {
-  if (Serial.readBytes(cmd_args, 4) != 4) {
+  int address, wLength;
+  if (!receive_words(&address, &wLength)) {
+    return;
+  }
+
+  program_words(address, wLength);
+
+  Serial.write('K');
+}
+
+void write_words_crc(void) {
+  int address, wLength;
+  if (!receive_words(&address, &wLength)) {
+    return;
+  }
+
+  char crc_bytes[2];
+  if (Serial.readBytes(crc_bytes, 2) != 2) {
+    Serial.write('D');
+    return;
+  }
+
+  // Check the block arrived intact before programming it
+  uint16_t crc = 0xFFFF;
+  for (int i=0; i < wLength * 2; i++) {
+    crc = crc16_update(crc, cmd_data[i]);
+  }
+  if (crc != (((uint8_t)crc_bytes[0] << 8) | (uint8_t)crc_bytes[1])) {
+    Serial.write('C');
+    Serial.write(crc >> 8);
+    Serial.write(crc & 0xFF);
+    return;
+  }
+
+  program_words(address, wLength);
+
+  // Read the block back and reply with its CRC instead of the data
+  icsp_load_pc(address);
+  delay(5);
+  crc = 0xFFFF;
+  for (int i=0; i < wLength; i++) {
+    int data = icsp_read_word(true);
+    crc = crc16_update(crc, data >> 8);
+    crc = crc16_update(crc, data & 0xFF);
+  }
+
+  Serial.write('K');
+  Serial.write(crc >> 8);
+  Serial.write(crc & 0xFF);
+}
+
+void stream_write(void) {
+  if (Serial.readBytes(cmd_args, 2) != 2) {
     // We didn't receive the correct amount of arguments in time
     // Return an error
     Serial.write('A');
     return;
   }
+
+  // Number of words in every row of the stream
+  int wLength = ((uint8_t)cmd_args[0] << 8) | (uint8_t)cmd_args[1];
+  int wLenBytes = wLength * 2;
+  if (wLength <= 0 || wLenBytes > (int)sizeof(cmd_data)) {
+    Serial.write('N');
+    return;
+  }
+  // Accept the stream before any row is sent, so a refused header never
+  // leaves row bytes to be run as commands
+  Serial.write('K');
+
+  // CRC-32 of everything read back since the stream started
+  uint32_t crc = 0xFFFFFFFF;
+  int rows = 0;
+  while (true) {
+    if (Serial.readBytes(cmd_args, 2) != 2) {
+      Serial.write('A');
+      return;
+    }
+    int address = ((uint8_t)cmd_args[0] << 8) | (uint8_t)cmd_args[1];
+    if (address == STREAM_END) {
+      break;
+    }
+
+    if (Serial.readBytes(cmd_data, wLenBytes) != wLenBytes) {
+      Serial.write('D');
+      return;
+    }
+
+    program_words(address, wLength);
+
+    icsp_load_pc(address);
+    delay(5);
+    for (int i=0; i < wLength; i++) {
+      int data = icsp_read_word(true);
+      crc = crc32_update(crc, data >> 8);
+      crc = crc32_update(crc, data & 0xFF);
+    }
+
+    if (++rows % STREAM_ACK_ROWS == 0) {
+      send_stream_ack(crc);
+    }
+  }
+
+  // The end marker always gets an ack covering the rows since the last one
+  send_stream_ack(crc);
+}
+
+void send_stream_ack(uint32_t crc) {
+  crc ^= 0xFFFFFFFF;
+  Serial.write('K');
+  Serial.write(crc >> 24);
+  Serial.write((crc >> 16) & 0xFF);
+  Serial.write((crc >> 8) & 0xFF);
+  Serial.write(crc & 0xFF);
+}
+
+// Receives the address, length and data of a 'w'/'W' command into cmd_data
+bool receive_words(int *address, int *wLength) {
+  if (Serial.readBytes(cmd_args, 4) != 4) {
+    // We didn't receive the correct amount of arguments in time
+    // Return an error
+    Serial.write('A');
+    return false;
+  }
   
   // Address to start writing
-  int address = (cmd_args[0] << 8) | cmd_args[1];
+  *address = (cmd_args[0] << 8) | cmd_args[1];
   // Number of words to write (len*2 bytes of data follows)
-  int wLength = (cmd_args[2] << 8) | cmd_args[3];
-  int wLenBytes = wLength * 2;
+  *wLength = (cmd_args[2] << 8) | cmd_args[3];
+  int wLenBytes = *wLength * 2;
 
   if (Serial.readBytes(cmd_data, wLenBytes) != wLenBytes) {
     // We didn't receive the correct amount of data in time
     // Return an error
     Serial.write('D');
-    return;
+    return false;
   }
 
+  return true;
+}
+
+void program_words(int address, int wLength) {
+  int wLenBytes = wLength * 2;
+
   icsp_load_pc(address);
 
   // Erase row (required for write)
   icsp_erase_row();
 
-  // Load all data latches except one
   int i;
+  if (address >= ICSP_CONFIG_BASE) {
+    // Configuration memory is programmed one word at a time, so a block of
+    // consecutive config words is written word by word
+    for (i=0; i < wLenBytes; i+=2) {
+      icsp_load_latch((cmd_data[i]<<8)|cmd_data[i+1], false);
+      icsp_begin_write();
+      icsp_increment_address();
+    }
+    return;
+  }
+
+  // Load all data latches except one
   for (i=0; i < wLenBytes-2; i+=2) {
     icsp_load_latch((cmd_data[i]<<8)|cmd_data[i+1], true);
     delayMicroseconds(ICSP_DELAY_DLY);
@@ -188,8 +370,45 @@ void write_words(void) {
 
   // Begin internal timed write
   icsp_begin_write();
+}
+
+// CRC-32 (reflected poly 0xEDB88320), matches Python's binascii.crc32 before the final inversion
+uint32_t crc32_update(uint32_t crc, uint8_t data) {
+  crc ^= data;
+  for (int i=0; i < 8; i++) {
+    crc = (crc & 1) ? (crc >> 1) ^ 0xEDB88320 : crc >> 1;
+  }
+  return crc;
+}
 
+// CRC-16/CCITT (poly 0x1021), matches Python's binascii.crc_hqx
+uint16_t crc16_update(uint16_t crc, uint8_t data) {
+  crc ^= (uint16_t)data << 8;
+  for (int i=0; i < 8; i++) {
+    crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+void set_baud(void) {
+  if (Serial.readBytes(cmd_args, 4) != 4) {
+    // We didn't receive the correct amount of arguments in time
+    // Return an error
+    Serial.write('A');
+    return;
+  }
+
+  uint32_t baud = ((uint32_t)(uint8_t)cmd_args[0] << 24) | ((uint32_t)(uint8_t)cmd_args[1] << 16) |
+                  ((uint32_t)(uint8_t)cmd_args[2] << 8) | (uint8_t)cmd_args[3];
+  if (baud < BAUD_MIN || baud > BAUD_MAX) {
+    Serial.write('N');
+    return;
+  }
+
+  // Acknowledge at the old rate, then switch once the ack has left the UART
   Serial.write('K');
+  Serial.flush();
+  Serial.updateBaudRate(baud);
 }
 
 void erase_row(void) {
@@ -280,6 +499,14 @@ void icsp_load_latch(int data, bool inc) {
   clockOutData(data);
 }
 
+#define ICSP_CMD_INC_ADDR 0xF8
+void icsp_increment_address(void) {
+  // Shift out command
+  clockOut(ICSP_CMD_INC_ADDR);
+
+  delayMicroseconds(ICSP_DELAY_DLY);
+}
+
 #define ICSP_CMD_ERASE_ROW  0xF0
 void icsp_erase_row(void) {
   // Shift out command
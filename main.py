@@ -2,156 +2,423 @@
 import sys
 import time
 import argparse
+import binascii
+import collections
+import concurrent.futures
 import configparser
+import itertools
 import serial
 import os
-from typing import Dict
+import re
+import struct
+from typing import Iterator, List, Tuple
 
-def int_to_bytes(number, length=2):
-    return number.to_bytes(length, 'big')
+# Number of commands sent back-to-back before waiting for their responses.
+# 8 rows of 32 words fit in the firmware's serial receive buffer.
+PIPELINE_DEPTH = 8
 
-def chunk_data(data_dict, chunk_size):
+# Blocks between progress line updates while flashing or verifying (one pipeline window).
+PROGRESS_INTERVAL = PIPELINE_DEPTH
+
+# Block command header sent to the programmer: opcode, word address, word count.
+COMMAND_HEADER = struct.Struct('>cHH')
+
+# Erase command sent to the programmer: opcode, word address.
+ADDRESS_COMMAND = struct.Struct('>cH')
+
+# Capability bits the firmware reports in reply to 'v' (firmware without 'v' answers 'U').
+CAP_CONFIG_BLOCK = 0x01  # 'w' programs a multi-word config block word by word
+CAP_CRC_WRITE = 0x02  # 'W': write a block, reply with the CRC-16 of its read-back
+CAP_SET_BAUD = 0x04   # 'B': switch the serial link to another baud rate
+CAP_STREAM_WRITE = 0x08  # 'S': stream rows back-to-back with a CRC-32 ack every few rows
+
+# Link speeds the firmware accepts for 'B' (BAUD_MIN/BAUD_MAX in icsp.ino).
+BAUD_MIN = 9600
+BAUD_MAX = 5000000
+
+# Rows acknowledged together by one 'S' stream ack; PIPELINE_DEPTH rows stay in flight.
+STREAM_ACK_ROWS = 4
+# Longest row an 'S' stream accepts (the firmware's 128-byte row buffer).
+STREAM_MAX_WORDS = 64
+# Row address that ends an 'S' stream (no row starts at the last word address).
+STREAM_END = 0xFFFF
+STREAM_ROW_ADDR = struct.Struct('>H')
+
+# Intel HEX record header: data length, 16-bit load offset, record type.
+HEX_RECORD_HEADER = struct.Struct('>BHB')
+
+# Tiles a big-endian read-back buffer word by word: group 1 matches runs of erased (0x3FFF)
+# words, the other branch runs of anything else, so every match stays 16-bit aligned.
+ERASED_RUNS = re.compile(rb'((?:\x3F\xFF)+)|(?:(?!\x3F\xFF)..)+', re.DOTALL)
+
+# Two-digit upper-case hex text for every byte value, used when emitting HEX records.
+HEX_BYTE = [f'{i:02X}' for i in range(256)]
+
+# Deletes every hex digit: whatever survives a translate() with it is not hex.
+STRIP_HEX_DIGITS = str.maketrans('', '', '0123456789abcdefABCDEF')
+
+def swap_words(data) -> bytes:
+    """Swaps the two bytes of every 16-bit word (little-endian image <-> big-endian wire format)."""
+    swapped = bytearray(len(data))
+    swapped[0::2], swapped[1::2] = data[1::2], data[0::2]
+    return bytes(swapped)
+
+def crc16(data) -> int:
+    """CRC-16/CCITT as computed by the firmware for 'W' blocks."""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def chunk_data(hex_image, chunk_size) -> List[Tuple[int, bytes]]:
     """
-    Groups individual words into chunks of exactly chunk_size.
+    Groups the words of a load_hex() memory image into chunks of exactly chunk_size.
     Pads with 0x3FFF (typical empty PIC flash value).
-    Returns a dict: {start_address: bytes_data (Big Endian for Serial)}
+    Returns a list of (start_address, bytes_data (Big Endian for Serial)) sorted by address.
     """
-    chunks = {}
-    for addr in sorted(data_dict.keys()):
-        base_addr = addr - (addr % chunk_size)
-        offset = addr - base_addr
-        
-        if base_addr not in chunks:
-            chunks[base_addr] = [0x3FFF] * chunk_size
-            
-        chunks[base_addr][offset] = data_dict[addr]
-
-    final_chunks = {}
-    for addr, words in chunks.items():
-        b_array = bytearray()
-        for w in words:
-            b_array.extend(w.to_bytes(2, 'big'))
-        final_chunks[addr] = bytes(b_array)
+    data, present, base_word = hex_image
+    # Every chunk touched by a run of loaded words, in address order.
+    chunk_ids = []
+    for start, end in iter_runs(present):
+        first = (base_word + start) // chunk_size
+        last = (base_word + end - 1) // chunk_size
+        if chunk_ids and chunk_ids[-1] == first:
+            first += 1
+        chunk_ids.extend(range(first, last + 1))
+
+    final_chunks = []
+    for chunk_id in chunk_ids:
+        # Gaps inside the image already read as 0x3FFF, so a chunk is a plain slice
+        # padded only where it reaches past either end of the image.
+        lo = chunk_id * chunk_size - base_word
+        hi = lo + chunk_size
+        start, end = max(lo, 0), min(hi, len(present))
+        words = data[start * 2:end * 2]
+        if start > lo or end < hi:
+            words = b'\xFF\x3F' * (start - lo) + words + b'\xFF\x3F' * (hi - end)
+        final_chunks.append((chunk_id * chunk_size, swap_words(words)))
     return final_chunks
 
-def load_hex(path: str, hex_byte_order: str = 'little') -> Dict[int, int]:
+def group_contiguous(hex_image, max_words) -> List[Tuple[int, bytes]]:
+    """
+    Packs the words of a load_hex() memory image into runs of consecutive addresses
+    (at most max_words long) so each run can go over the wire as a single block.
+    Returns a list of (start_address, bytes_data (Big Endian for Serial)) sorted by address.
     """
-    Loads an Intel HEX file and returns the memory map dictionary 
-    {word_address: int_value} using a fixed word size of 2 bytes (16-bit).
+    data, present, base_word = hex_image
+    runs = []
+    for start, end in iter_runs(present):
+        for i in range(start, end, max_words):
+            part_end = min(i + max_words, end)
+            runs.append((base_word + i, swap_words(data[i * 2:part_end * 2])))
+    return runs
+
+def is_hex_string(text: str) -> bool:
+    """
+    Checks for an even number of hex digits with one table lookup per character; unlike
+    fromhex() this also rejects embedded whitespace.
+    """
+    return len(text) % 2 == 0 and not text.translate(STRIP_HEX_DIGITS)
+
+def parse_hex_records(buf: bytearray, record_ends, hex_byte_order: str = 'little') -> Tuple[bytearray, bytearray, int]:
+    """
+    Builds the load_hex() memory image from already decoded Intel HEX records packed
+    back-to-back in buf, where record i ends at byte offset record_ends[i].
+    This is the whole per-record hot loop; it does no text handling or file I/O.
     """
     WORD_SIZE = 2
-    words: Dict[int, int] = {}
+    data = bytearray()
+    present = bytearray()
+    base_word: int = 0
+    used: int = 0
     high_address_offset: int = 0
-    
-    try:
-        with open(path, 'r') as f:
-            hexfile_data = f.read().replace('\n', '').replace('\r', '')
+    swap_bytes = hex_byte_order == 'big'
+
+    # Headers are unpacked in place and payloads sliced out as zero-copy views.
+    all_view = memoryview(buf)
+    record_offset = 0
+    for record_end in record_ends:
+        data_len, offset_addr, record_type = HEX_RECORD_HEADER.unpack_from(buf, record_offset)
+        data_bytes = all_view[record_offset + 4:min(record_offset + 4 + data_len, record_end)]
+        record_offset = record_end
+
+        if record_type == 4 and data_len == 2:
+            high_address = int.from_bytes(data_bytes, 'big')
+            high_address_offset = (high_address << 16) // WORD_SIZE
         
-        ascii_records = hexfile_data.lstrip(':').split(':')
-
-        for record in ascii_records:
-            if not record: 
-                continue
-            
-            try:
-                data_len = int(record[0:2], base=16) 
-                offset_addr = int(record[2:6], base=16)
-                record_type = int(record[6:8], base=16)
-                
-                end_data_idx = (data_len * 2) + 8
-                data_bytes = bytearray.fromhex(record[8:end_data_idx]) 
-            except ValueError:
+        elif record_type == 0:
+            word_count = len(data_bytes) // WORD_SIZE
+            if not word_count:
                 continue
+            word_base = high_address_offset + offset_addr // WORD_SIZE
+
+            if not used:
+                base_word = word_base
+            elif word_base < base_word:
+                shift = base_word - word_base
+                data[0:0] = b'\xFF\x3F' * shift
+                present[0:0] = bytes(shift)
+                base_word = word_base
+                used += shift
+
+            start = word_base - base_word
+            end = start + word_count
+            if end > len(present):
+                grow = max(end, 2 * len(present)) - len(present)
+                data.extend(b'\xFF\x3F' * grow)
+                present.extend(bytes(grow))
+
+            byte_start, byte_end = start * WORD_SIZE, end * WORD_SIZE
+            packed = data_bytes[:byte_end - byte_start]
+            if swap_bytes:
+                data[byte_start:byte_end:2], data[byte_start + 1:byte_end:2] = packed[1::2], packed[0::2]
+            else:
+                data[byte_start:byte_end] = packed
+            present[start:end] = b'\x01' * word_count
+            used = max(used, end)
 
-            if record_type == 4 and data_len == 2:
-                high_address = int.from_bytes(data_bytes, 'big')
-                high_address_offset = (high_address << 16) // WORD_SIZE
-            
-            elif record_type == 0:
-                current_low_address = offset_addr // WORD_SIZE
-                
-                for i in range(0, data_len, WORD_SIZE):
-                    address = high_address_offset + current_low_address
-                    word = int.from_bytes(data_bytes[i : i + WORD_SIZE], hex_byte_order)
-                    words[address] = word
-                    current_low_address += 1
+    del data[used * WORD_SIZE:]
+    del present[used:]
+    return data, present, base_word
 
-        return words
-        
+def parse_hex_file(path: str, hex_byte_order: str = 'little') -> Tuple[bytearray, bytearray, int]:
+    """
+    Does the work of load_hex() but lets errors propagate instead of printing them,
+    so it can run on a worker thread and have its errors reported by the caller.
+    """
+    # First pass: collect the hex text of every record (header, data and checksum).
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) < 9 or line[0] != ':':
+                continue
+            # Only data (00) and extended linear address (04) records are used; nothing
+            # after the end-of-file record (01) belongs to the image.
+            record_type = line[7:9]
+            if record_type == '01':
+                break
+            if record_type != '00' and record_type != '04':
+                continue
+            # A dangling half byte can only be part of the checksum, which is not checked.
+            records.append(line[1:len(line) - (len(line) - 1) % 2])
+
+    # Decode every record with a single fromhex call instead of one per record.
+    # fromhex() skips whitespace, which would shift every later record, so the text is
+    # checked up front; only a malformed file pays for checking record by record.
+    all_text = ''.join(records)
+    if not is_hex_string(all_text):
+        records = [record for record in records if is_hex_string(record)]
+        all_text = ''.join(records)
+    all_bytes = bytearray.fromhex(all_text)
+
+    record_ends = itertools.accumulate(len(record) // 2 for record in records)
+    return parse_hex_records(all_bytes, record_ends, hex_byte_order)
+
+def load_hex(path: str, hex_byte_order: str = 'little') -> Tuple[bytearray, bytearray, int]:
+    """
+    Loads an Intel HEX file into a flat memory image using a fixed word size of 2 bytes (16-bit).
+    Returns (data, present, base_word): data holds every word little-endian (gaps read as 0x3FFF),
+    present holds one byte per word (1 = loaded from the file) and base_word is the word address
+    of index 0. Both buffers are grown by doubling instead of allocating one object per word.
+    """
+    try:
+        return parse_hex_file(path, hex_byte_order)
     except FileNotFoundError:
         print(f"Error: File not found at path: {path}")
-        return {}
+        return bytearray(), bytearray(), 0
     except Exception as e:
         print(f"An error occurred during decoding: {e}")
-        return {}
+        return bytearray(), bytearray(), 0
 
-def save_hex(path: str, data_dict: Dict[int, int]):
+def iter_runs(present: bytearray) -> Iterator[Tuple[int, int]]:
+    """
+    Yields (start, end) index ranges of consecutive words marked in a load_hex() present map.
+    Walks the map one run at a time with bytes.find, so gaps cost nothing.
     """
-    Saves a memory dictionary {word_address: int_value} to an Intel HEX file.
+    end = 0
+    while end < len(present):
+        start = present.find(b'\x01', end)
+        if start < 0:
+            return
+        end = present.find(b'\x00', start)
+        if end < 0:
+            end = len(present)
+        yield start, end
+
+def image_span(hex_image, start_addr: int, end_addr: int) -> Tuple[int, int]:
+    """Returns the index range of word addresses start_addr <= addr < end_addr, clipped to the image."""
+    _, present, base_word = hex_image
+    start = min(max(0, start_addr - base_word), len(present))
+    end = min(max(start, end_addr - base_word), len(present))
+    return start, end
+
+def split_memory(hex_image, rom_size, config_mem_start, config_mem_end):
+    """
+    Splits a load_hex() memory image into (program_image, config_image), both in the
+    same (data, present, base_word) layout. Each address range is cut out with a slice;
+    a config range that overlaps program memory is blanked out of the program image.
+    """
+    data, present, base_word = hex_image
+    start, end = image_span(hex_image, config_mem_start, config_mem_end + 1)
+    config_image = (data[start * 2:end * 2], present[start:end], base_word + start)
+
+    start, end = image_span(hex_image, 0, rom_size)
+    flash_image = (data[start * 2:end * 2], present[start:end], base_word + start)
+    start, end = image_span(flash_image, config_mem_start, config_mem_end + 1)
+    flash_image[0][start * 2:end * 2] = b'\xFF\x3F' * (end - start)
+    flash_image[1][start:end] = bytes(end - start)
+    return flash_image, config_image
+
+def save_hex(path: str, data: bytearray, present: bytearray, base_word: int = 0):
+    """
+    Saves a memory image (the same data/present/base_word layout load_hex() returns)
+    to an Intel HEX file. Only words marked in present are written; each contiguous run is
+    cut into 16-byte records straight from the little-endian image.
     Converts 16-bit word addresses to byte addresses and handles Extended Linear Address records.
     """
+    LINE_BYTES = 16
     try:
-        with open(path, 'w') as f:
-            sorted_addrs = sorted(data_dict.keys())
-            if not sorted_addrs:
-                return
-
+        with open(path, 'wb', buffering=1 << 20) as f:
             current_high_addr = 0
-            
-            line_data = bytearray()
-            line_start_addr = -1
+            lines = []
             
             def write_record(address, record_type, data):
                 count = len(data)
-                checksum = count + (address >> 8) + (address & 0xFF) + record_type + sum(data)
-                checksum = (~checksum + 1) & 0xFF
-                hex_str = f":{count:02X}{address:04X}{record_type:02X}{data.hex().upper()}{checksum:02X}\n"
-                f.write(hex_str)
-
-            for i, word_addr in enumerate(sorted_addrs):
-                byte_addr = word_addr * 2
-                
-                high_addr = byte_addr >> 16
-                low_addr = byte_addr & 0xFFFF
-                
-                if high_addr != current_high_addr:
-                    if line_data:
-                        write_record(line_start_addr, 0x00, line_data)
-                        line_data = bytearray()
-                    
-                    high_bytes = high_addr.to_bytes(2, 'big')
-                    write_record(0x0000, 0x04, high_bytes)
-                    current_high_addr = high_addr
-
-                if (line_start_addr == -1) or \
-                   (low_addr != line_start_addr + len(line_data)) or \
-                   (len(line_data) >= 16):
-                    
-                    if line_data:
-                        write_record(line_start_addr, 0x00, line_data)
-                    
-                    line_start_addr = low_addr
-                    line_data = bytearray()
-
-                word_val = data_dict[word_addr]
-                line_data.extend(word_val.to_bytes(2, 'little'))
-
-            if line_data:
-                write_record(line_start_addr, 0x00, line_data)
+                checksum = -(count + (address >> 8) + (address & 0xFF) + record_type + sum(data)) & 0xFF
+                lines.append(
+                    f":{HEX_BYTE[count]}{address:04X}{HEX_BYTE[record_type]}{data.hex().upper()}{HEX_BYTE[checksum]}\n"
+                )
+
+            for run_start, run_end in iter_runs(present):
+                # Walk the run in byte offsets; the address only needs converting once per run.
+                byte_addr = (base_word + run_start) * 2
+                offset, end_offset = run_start * 2, run_end * 2
+                while offset < end_offset:
+                    high_addr = byte_addr >> 16
+                    if high_addr != current_high_addr:
+                        write_record(0x0000, 0x04, high_addr.to_bytes(2, 'big'))
+                        current_high_addr = high_addr
+
+                    # A record never spans two 64 KB segments.
+                    line_len = min(LINE_BYTES, end_offset - offset, ((high_addr + 1) << 16) - byte_addr)
+                    write_record(byte_addr & 0xFFFF, 0x00, data[offset:offset + line_len])
+                    offset += line_len
+                    byte_addr += line_len
+
+            if not lines:
+                return
 
             write_record(0x0000, 0x01, b'')
+            f.write(''.join(lines).encode('ascii'))
             
-        print(f"Saved {len(data_dict)} words to {path}")
+        print(f"Saved {present.count(1)} words to {path}")
 
     except Exception as e:
         print(f"Error saving hex file: {e}")
 
+def check_flash_replies(replies, dry_run=False):
+    """
+    Checks (addr, data_bytes, acked, read_back) replies from ArduinoProgrammer.write_block_async().
+    Returns the failing replies in order; an empty list means every block was written and verified.
+    """
+    return [
+        reply for reply in replies
+        if not reply[2] or (not dry_run and reply[3] != reply[1])
+    ]
+
+def report_flash_failure(prog, replies):
+    """
+    Prints the first really failing block of check_flash_replies() output. Blocks verified by
+    CRC carry no read-back; a stream ack covers several rows at once, so each of them is read
+    back here (once the link is idle again) until the bad one is found.
+    """
+    for addr, data, acked, verify_data in replies:
+        if not acked:
+            print(f"\nWRITE FAIL at 0x{addr:04X}")
+            return
+        if verify_data is None and prog.caps & (CAP_CRC_WRITE | CAP_STREAM_WRITE):
+            verify_data = prog.read_block(addr, len(data) // 2)
+            if verify_data == data:
+                continue
+        got = verify_data.hex() if verify_data is not None else "nothing"
+        print(f"\nVERIFY FAIL at 0x{addr:04X} expected {data.hex()}, got {got}")
+        if verify_data is not None and len(verify_data) == len(data):
+            print(f"  {describe_mismatch(addr, data, verify_data)}")
+        return
+    print(f"\nVERIFY FAIL at 0x{replies[0][0]:04X}: checksum mismatch, but the rows read back correctly")
+
+def first_mismatch(expected: bytes, actual: bytes) -> int:
+    """
+    Returns the index of the first 16-bit word that differs between two equally long
+    big-endian blocks. Both are XORed as one integer, so the scan runs in C.
+    """
+    diff = int.from_bytes(expected, 'big') ^ int.from_bytes(actual, 'big')
+    return (len(expected) - (diff.bit_length() + 7) // 8) // 2
+
+def describe_mismatch(addr, expected, actual):
+    """Names the first differing word of a block that failed verification."""
+    i = first_mismatch(expected, actual)
+    return (f"first difference at 0x{addr + i:04X}: "
+            f"expected {expected[2 * i:2 * i + 2].hex().upper()}, got {actual[2 * i:2 * i + 2].hex().upper()}")
+
+def verify_chunks(prog, chunks, memory_type):
+    """
+    Reads back every (addr, expected_bytes) block and compares it with the expected data.
+    Prints the first mismatch and returns False, or returns True if every block matched.
+    """
+    verify_error = False
+    print(f"Verifying {len(chunks)} {memory_type} blocks...")
+    for i, (addr, expected_data) in enumerate(chunks):
+        word_count = len(expected_data) // 2
+        if i % PROGRESS_INTERVAL == 0:
+            print(f"\rVerifying 0x{addr:04X} ({memory_type})...", end='', flush=True)
+        actual_data = prog.read_block(addr, word_count)
+        if actual_data is None:
+            print(f"\nREAD FAIL at 0x{addr:04X}")
+            verify_error = True
+            break
+        if actual_data != expected_data:
+            print(f"\nFAIL at 0x{addr:04X}: Expected {expected_data.hex()}, got {actual_data.hex()}")
+            print(f"  {describe_mismatch(addr, expected_data, actual_data)}")
+            verify_error = True
+            break
+    else:
+        print(" OK")
+    return not verify_error
+
+def baud_rate(text: str) -> int:
+    """argparse type for --baud: an integer rate the firmware can switch to."""
+    try:
+        baud = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid baud rate: {text!r}")
+    if not BAUD_MIN <= baud <= BAUD_MAX:
+        raise argparse.ArgumentTypeError(f"baud rate must be between {BAUD_MIN} and {BAUD_MAX}")
+    return baud
+
 class ArduinoProgrammer:
-    def __init__(self, port, baud=115200, dry_run=False):
+    def __init__(self, port, baud=115200, dry_run=False, link_baud=None, use_cache=True):
         self.dry_run = dry_run
         self.port = port
         self.baud = baud
+        # Baud rate to switch to after the handshake (None = stay at baud).
+        self.link_baud = link_baud
         self.ser = None
+        # Reused transmit buffer: 'w'/'r' commands are packed into it and sent with one write().
+        self.tx_buf = bytearray(1024)
+        # Blocks written with write_block_async() whose replies have not been read yet
+        # (whole ack windows of (rows, crc32) while an 'S' stream is open).
+        self._pending = collections.deque()
+        # Row size in words of the open 'S' stream (None = no stream), the rows sent since
+        # its last ack window was closed and the running CRC-32 of everything streamed.
+        self._stream_words = None
+        self._stream_rows = []
+        self._stream_crc = 0
+        # Capability bits reported by the firmware (see the CAP_* constants).
+        self.caps = 0
+        # (addr, word_count) -> block contents known to be on the device, so verify passes
+        # after a flash (or a second read of the same block) need no serial round trip.
+        # Entries are dropped when the words are rewritten or erased.
+        self.use_cache = use_cache
+        self.read_cache = {}
 
     def connect(self, lvp=False):
         command_byte = b'l' if lvp else b's'
@@ -163,12 +430,26 @@ class ArduinoProgrammer:
             return True
 
         try:
-            self.ser = serial.Serial(self.port, self.baud, timeout=5)
+            # A write that cannot drain within 5 s fails instead of blocking forever.
+            self.ser = serial.Serial(self.port, self.baud, timeout=5, write_timeout=5)
+            try:
+                # Room for a whole pipelined window on both sides (only supported on Windows).
+                self.ser.set_buffer_size(rx_size=65536, tx_size=65536)
+            except (AttributeError, OSError):
+                pass
             print(f"Connecting ({mode_name})...", end=' ', flush=True)
             time.sleep(2) 
             self.ser.write(command_byte)
             if self.ser.read() == b'K':
                 print("Success.")
+                try:
+                    self.caps = self.probe_caps()
+                    if self.link_baud and self.link_baud != self.baud:
+                        return self.switch_baud(self.link_baud)
+                except Exception:
+                    # The target is already in programming mode: release it before giving up.
+                    self.disconnect()
+                    raise
                 return True
             print("Failed (No 'K' response).")
             return False
@@ -176,6 +457,55 @@ class ArduinoProgrammer:
             print(f"Connection Error: {e}")
             return False
 
+    def probe_caps(self):
+        # Older firmware answers the unknown 'v' command with a single 'U'.
+        self.ser.write(b'v')
+        if self.ser.read() != b'K':
+            return 0
+        caps = self.ser.read()
+        return caps[0] if caps else 0
+
+    def switch_baud(self, new_baud):
+        # Asks the firmware to move to new_baud. The 'K' still arrives at the old rate; both ends
+        # switch after it. Firmware without CAP_SET_BAUD, or one that answers 'N', stays where it is.
+        # The firmware drops back to 115200 itself on 'x', so the next session can open there.
+        if not self.caps & CAP_SET_BAUD:
+            print(f"Programmer firmware cannot change baud rate, staying at {self.baud}.")
+            return True
+        self.ser.write(b'B' + new_baud.to_bytes(4, 'big'))
+        if self.ser.read() != b'K':
+            print(f"Programmer rejected {new_baud} baud, staying at {self.baud}.")
+            return True
+
+        self.ser.baudrate = new_baud
+        time.sleep(0.05)
+        self.ser.reset_input_buffer()
+        # Re-probe at the new rate to make sure the link survived the switch.
+        if self.probe_caps() != self.caps:
+            print(f"No response after switching to {new_baud} baud.")
+            # The target is already in programming mode: try to release it before giving up.
+            self.disconnect()
+            return False
+        print(f"Switched to {new_baud} baud.")
+        self.baud = new_baud
+        return True
+
+    def send_commands(self, commands):
+        # Packs (opcode, addr, word_count, payload) commands back-to-back into tx_buf and
+        # sends them all with a single write. tx_buf only grows, so the flashing loop
+        # stops allocating once it has seen its largest window.
+        total = sum(COMMAND_HEADER.size + len(payload) for *_, payload in commands)
+        if total > len(self.tx_buf):
+            self.tx_buf.extend(bytes(total - len(self.tx_buf)))
+
+        offset = 0
+        for opcode, addr, word_count, payload in commands:
+            COMMAND_HEADER.pack_into(self.tx_buf, offset, opcode, addr, word_count)
+            offset += COMMAND_HEADER.size
+            self.tx_buf[offset:offset + len(payload)] = payload
+            offset += len(payload)
+        self.ser.write(memoryview(self.tx_buf)[:offset])
+
     def disconnect(self):
         if self.dry_run:
             print("[DRY RUN] Disconnected.")
@@ -190,35 +520,171 @@ class ArduinoProgrammer:
         if self.dry_run:
             return True
 
-        self.ser.write(b'w')
-        self.ser.write(int_to_bytes(addr))
-        self.ser.write(int_to_bytes(len(data_bytes)//2))
-        self.ser.write(data_bytes)
+        self.forget_cached(addr, len(data_bytes) // 2)
+        self.send_commands([(b'w', addr, len(data_bytes)//2, data_bytes)])
         return self.ser.read() == b'K'
 
+    def forget_cached(self, addr, word_count):
+        # Drops cached blocks overlapping the words about to be rewritten. This scans the whole
+        # cache, so it is only used for arbitrary write_block() ranges; flash rows written with
+        # write_block_async() are aligned and never overlap, so they just pop their own key.
+        self.read_cache = {
+            (start, count): data for (start, count), data in self.read_cache.items()
+            if start + count <= addr or start >= addr + word_count
+        }
+
+    def write_block_async(self, addr, data_bytes):
+        # Sends a block write immediately followed by its read-back request, without waiting
+        # for the reply, so the device always has the next block queued while it programs.
+        # With CAP_CRC_WRITE firmware a 'W' command replaces the pair and only the CRC of the
+        # read-back comes back. At most PIPELINE_DEPTH blocks are kept in flight: once the
+        # window is full the oldest reply is collected first. Returns the replies collected to
+        # make room, as (addr, data_bytes, acked, read_back) tuples.
+        if self.dry_run:
+            return [(addr, data_bytes, True, None)]
+
+        completed = []
+        word_count = len(data_bytes) // 2
+        if self.caps & CAP_STREAM_WRITE and 0 < word_count <= STREAM_MAX_WORDS:
+            if self._stream_words != word_count:
+                completed.extend(self.drain_acks())
+                self._start_stream(word_count)
+            if self._stream_words == word_count:
+                return completed + self._stream_block(addr, data_bytes)
+        elif self._stream_words is not None:
+            # A block that cannot be streamed ends the open stream first.
+            completed.extend(self.drain_acks())
+
+        if len(self._pending) >= PIPELINE_DEPTH:
+            completed.append(self._collect_reply())
+        self.read_cache.pop((addr, len(data_bytes) // 2), None)
+        if self.caps & CAP_CRC_WRITE:
+            crc = crc16(data_bytes)
+            self.send_commands([(b'W', addr, len(data_bytes)//2, data_bytes + crc.to_bytes(2, 'big'))])
+        else:
+            crc = None
+            self.send_commands([
+                (b'w', addr, len(data_bytes)//2, data_bytes),
+                (b'r', addr, len(data_bytes)//2, b''),
+            ])
+        self._pending.append((addr, data_bytes, crc))
+        return completed
+
+    def drain_acks(self):
+        # Collects the replies of every block still in flight, oldest first.
+        if self._stream_words is not None:
+            return self._end_stream()
+        return [self._collect_reply() for _ in range(len(self._pending))]
+
+    def _start_stream(self, word_count):
+        # Opens an 'S' stream of word_count-word rows. Nothing else is in flight here, so the
+        # header's own 'K' can be waited for: if the firmware refuses the stream ('N') no row
+        # byte is ever sent, and streaming is switched off for the rest of the session.
+        self.ser.write(ADDRESS_COMMAND.pack(b'S', word_count))
+        if self.ser.read() != b'K':
+            self.caps &= ~CAP_STREAM_WRITE
+            return
+        self._stream_words = word_count
+        self._stream_crc = 0
+
+    def _stream_block(self, addr, data_bytes):
+        # write_block_async() for an open 'S' stream: rows go out as address + data and are
+        # acknowledged STREAM_ACK_ROWS at a time with the CRC-32 of their read-back, so there
+        # is no per-row command or reply at all.
+        completed = []
+        word_count = len(data_bytes) // 2
+        while self._pending and len(self._pending) * STREAM_ACK_ROWS + len(self._stream_rows) >= PIPELINE_DEPTH:
+            completed.extend(self._collect_window())
+
+        self.read_cache.pop((addr, word_count), None)
+        self.ser.write(STREAM_ROW_ADDR.pack(addr) + data_bytes)
+        self._stream_crc = binascii.crc32(data_bytes, self._stream_crc)
+        self._stream_rows.append((addr, data_bytes))
+        if len(self._stream_rows) == STREAM_ACK_ROWS:
+            self._pending.append((self._stream_rows, self._stream_crc))
+            self._stream_rows = []
+        return completed
+
+    def _end_stream(self):
+        # Closes the open 'S' stream; the device acks whatever rows are left (possibly none).
+        self._pending.append((self._stream_rows, self._stream_crc))
+        self._stream_rows = []
+        self._stream_words = None
+        self.ser.write(STREAM_ROW_ADDR.pack(STREAM_END))
+        completed = []
+        while self._pending:
+            completed.extend(self._collect_window())
+        return completed
+
+    def _collect_window(self):
+        # Reads one 'K' + CRC-32 stream ack; every row of the window shares its outcome.
+        rows, crc = self._pending.popleft()
+        resp = self.ser.read(5)
+        acked = resp[:1] == b'K'
+        verified = resp[1:] == crc.to_bytes(4, 'big')
+        if acked and verified and self.use_cache:
+            for addr, data_bytes in rows:
+                self.read_cache[(addr, len(data_bytes) // 2)] = bytes(data_bytes)
+        return [(addr, data_bytes, acked, data_bytes if verified else None) for addr, data_bytes in rows]
+
+    def _collect_reply(self):
+        # Reads the 'K' ack and read-back (or its CRC) of the oldest in-flight block with a single read.
+        # A block whose CRC matches is reported with its own data as read_back, otherwise None.
+        addr, data_bytes, crc = self._pending.popleft()
+        if crc is not None:
+            resp = self.ser.read(3)
+            read_back = data_bytes if resp[1:] == crc.to_bytes(2, 'big') else None
+        else:
+            resp = self.ser.read(1 + len(data_bytes))
+            read_back = resp[1:] if len(resp) == 1 + len(data_bytes) else None
+        acked = resp[:1] == b'K'
+        if acked and read_back == data_bytes and self.use_cache:
+            self.read_cache[(addr, len(data_bytes) // 2)] = bytes(data_bytes)
+        return addr, data_bytes, acked, read_back
+
     def read_block(self, addr, word_count):
         if self.dry_run:
             return b'\x3F\xFF' * word_count
 
-        self.ser.write(b'r')
-        self.ser.write(int_to_bytes(addr))
-        self.ser.write(int_to_bytes(word_count))
+        cached = self.read_cache.get((addr, word_count))
+        if cached is not None:
+            return cached
+
+        self.send_commands([(b'r', addr, word_count, b'')])
         resp = self.ser.read(word_count * 2)
-        return resp if len(resp) == word_count * 2 else None
+        if len(resp) != word_count * 2:
+            return None
+        if self.use_cache:
+            self.read_cache[(addr, word_count)] = resp
+        return resp
+
+    def read_block_into(self, addr, word_count, mv_out):
+        return self.read_blocks_into([(addr, word_count)], mv_out) == word_count * 2
+
+    def read_blocks_into(self, requests, mv_out):
+        # Sends every (addr, word_count) read header in one go, then reads all replies
+        # back-to-back straight into the writable buffer mv_out. Returns the byte count received.
+        total = sum(word_count for _, word_count in requests) * 2
+        if self.dry_run:
+            mv_out[:total] = b'\x3F\xFF' * (total // 2)
+            return total
+
+        self.send_commands([(b'r', addr, word_count, b'') for addr, word_count in requests])
+        return self.ser.readinto(mv_out[:total])
     
     def erase_row(self, addr):
         if self.dry_run:
             return True
-        self.ser.write(b'e') 
-        self.ser.write(int_to_bytes(addr))
+        self.read_cache.clear()
+        self.ser.write(ADDRESS_COMMAND.pack(b'e', addr))
         resp = self.ser.read()
         return resp == b'K'
     
     def bulk_erase(self, addr):
         if self.dry_run:
             return True
-        self.ser.write(b'b') 
-        self.ser.write(int_to_bytes(addr))
+        self.read_cache.clear()
+        self.ser.write(ADDRESS_COMMAND.pack(b'b', addr))
         resp = self.ser.read()
         return resp == b'K'
 
@@ -230,6 +696,8 @@ def main():
     parser.add_argument('-p', '--port', required=True, help='Serial Port.')
     parser.add_argument('--lvp', action='store_true', help='Use Low-Voltage Programming (LVP) mode instead of High-Voltage Programming (HVP).')
     parser.add_argument('--dry-run', action='store_true', help='Simulate without hardware.')
+    parser.add_argument('--no-cache', action='store_true', help='Always read blocks back from the device instead of reusing data already read or verified this session.')
+    parser.add_argument('--baud', type=baud_rate, default=115200, help='Serial baud rate to switch to after connecting (default: 115200).')
     parser.add_argument('-c', '--config', action='store_true', help='Also include config words (applies to -f and -v).')
     parser.add_argument('-f', '--flash', action='store_true', help='Write hexfile to device flash memory.')
     parser.add_argument('-v', '--verify', action='store_true', help='Verify hexfile against device memory.')
@@ -288,7 +756,26 @@ def main():
 
     print(f"Dry Run: {args.dry_run}")
 
-    prog = ArduinoProgrammer(args.port, dry_run=args.dry_run)
+    hex_future = None
+    if args.hexfile and (args.flash or args.verify):
+        # Parse the HEX file while connect() waits for the programmer to come out of reset.
+        loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        hex_future = loader.submit(parse_hex_file, args.hexfile)
+        loader.shutdown(wait=False)
+
+    def loaded_hex():
+        # Collects the background parse, reporting its errors here on the main thread the
+        # same way load_hex() does.
+        try:
+            return hex_future.result()
+        except FileNotFoundError:
+            print(f"Error: File not found at path: {args.hexfile}")
+            return bytearray(), bytearray(), 0
+        except Exception as e:
+            print(f"An error occurred during decoding: {e}")
+            return bytearray(), bytearray(), 0
+
+    prog = ArduinoProgrammer(args.port, dry_run=args.dry_run, link_baud=args.baud, use_cache=not args.no_cache)
     if not prog.connect(lvp=args.lvp):
         sys.exit(1)
 
@@ -300,60 +787,58 @@ def main():
             print("OK.")
         
         if args.flash and args.hexfile:
-            raw_data = load_hex(args.hexfile)
-            flash_data = {}
-            config_data = {}
-            for addr, word in raw_data.items():
-                if config_mem_start <= addr <= config_mem_end:
-                    config_data[addr] = word
-                elif addr < rom_size:
-                    flash_data[addr] = word
+            hex_image = loaded_hex()
+            flash_image, config_image = split_memory(hex_image, rom_size, config_mem_start, config_mem_end)
+            config_words = config_image[1].count(1)
             
-            flash_chunks = chunk_data(flash_data, flash_write_size)
+            flash_chunks = chunk_data(flash_image, flash_write_size)
             print(f"Flashing {len(flash_chunks)} program blocks...")
             
-            flash_error = False
-            for addr, data in sorted(flash_chunks.items()):
-                print(f"Writing 0x{addr:04X}...", end=' ')
-                if not prog.write_block(addr, data):
-                    print("WRITE FAIL")
-                    flash_error = True
+            failed = []
+            for i, (addr, data) in enumerate(flash_chunks):
+                if i % PROGRESS_INTERVAL == 0:
+                    print(f"\rWriting 0x{addr:04X}... ({i}/{len(flash_chunks)})", end='', flush=True)
+                failed = check_flash_replies(prog.write_block_async(addr, data), args.dry_run)
+                if failed:
                     break
-                if args.dry_run:
-                    print("OK (Simulated)")
-                else:
-                    verify_data = prog.read_block(addr, len(data)//2)
-                    if verify_data != data:
-                        print(f"VERIFY FAIL at 0x{addr:04X} expected {data.hex()}, got {verify_data.hex()}")
-                        flash_error = True
-                        break
-                    print("OK")
+
+            # Collect the blocks still in flight; after a failure this keeps the link in sync.
+            in_flight = prog.drain_acks()
+            if not failed:
+                failed = check_flash_replies(in_flight, args.dry_run)
+            flash_error = bool(failed)
+            if flash_error:
+                report_flash_failure(prog, failed)
+            elif flash_chunks:
+                print(f"\rWriting 0x{flash_chunks[-1][0]:04X}... ({len(flash_chunks)}/{len(flash_chunks)}) " +
+                      ("OK (Simulated)" if args.dry_run else "OK"))
             
             if flash_error:
                 print("FLASHING FAILED.")
-            elif args.config and config_data:
-                print(f"Writing {len(config_data)} Configuration words...")
-                config_write_chunks = {}
-                for addr, word in sorted(config_data.items()):
-                    config_write_chunks[addr] = word.to_bytes(2, 'big') 
+            elif args.config and config_words:
+                print(f"Writing {config_words} Configuration words...")
+                # Contiguous config words are written as one block instead of one command per word,
+                # unless the firmware would latch such a block as a single row (no CAP_CONFIG_BLOCK).
+                config_block_words = flash_write_size if prog.caps & CAP_CONFIG_BLOCK else 1
+                config_write_chunks = group_contiguous(config_image, config_block_words)
 
                 config_ok = True
-                for addr, data in sorted(config_write_chunks.items()):
-                    print(f"Writing Config 0x{addr:04X}...", end=' ')
+                for addr, data in config_write_chunks:
+                    print(f"\rWriting Config 0x{addr:04X}...", end='', flush=True)
                     if not prog.write_block(addr, data):
-                        print("CONFIG WRITE FAIL")
+                        print(" CONFIG WRITE FAIL")
                         config_ok = False
                         break
                     
-                    if args.dry_run:
-                        print("OK (Simulated)")
-                    else:
-                        verify_data = prog.read_block(addr, 1)
+                    if not args.dry_run:
+                        verify_data = prog.read_block(addr, len(data) // 2)
                         if verify_data != data:
-                            print(f"CONFIG VERIFY FAIL at 0x{addr:04X} expected {data.hex()}, got {verify_data.hex()}")
+                            got = verify_data.hex() if verify_data is not None else "nothing"
+                            print(f" CONFIG VERIFY FAIL at 0x{addr:04X} expected {data.hex()}, got {got}")
                             config_ok = False
                             break
-                        print("OK")
+                else:
+                    print(" OK (Simulated)" if args.dry_run else " OK")
                 
                 if config_ok:
                     print("FLASH & VERIFY COMPLETE: SUCCESS")
@@ -363,41 +848,15 @@ def main():
                 print("FLASH COMPLETE: SUCCESS")
 
         if args.verify and args.hexfile:
-            def verify_chunks(prog, chunks, memory_type):
-                verify_error = False
-                print(f"Verifying {len(chunks)} {memory_type} blocks...")
-                for addr, expected_data in sorted(chunks.items()):
-                    word_count = len(expected_data) // 2
-                    print(f"Verifying 0x{addr:04X} ({memory_type})...", end=' ')
-                    actual_data = prog.read_block(addr, word_count)
-                    if actual_data is None:
-                        print("READ FAIL")
-                        verify_error = True
-                        break
-                    if actual_data != expected_data:
-                        print(f"FAIL: Expected {expected_data.hex()}, got {actual_data.hex()}")
-                        verify_error = True
-                        break
-                    print("OK")
-                return not verify_error
-
-            raw_data = load_hex(args.hexfile)
-            flash_data = {}
-            config_data = {}
-            for addr, word in raw_data.items():
-                if config_mem_start <= addr <= config_mem_end:
-                    config_data[addr] = word
-                elif addr < rom_size:
-                    flash_data[addr] = word
-
-            flash_chunks = chunk_data(flash_data, flash_write_size)
+            hex_image = loaded_hex()
+            flash_image, config_image = split_memory(hex_image, rom_size, config_mem_start, config_mem_end)
+
+            flash_chunks = chunk_data(flash_image, flash_write_size)
             flash_ok = verify_chunks(prog, flash_chunks, "Program Flash")
             
             config_ok = True
-            if config_data:
-                config_chunks = {}
-                for addr, word in sorted(config_data.items()):
-                    config_chunks[addr] = word.to_bytes(2, 'big')
+            if config_image[1].count(1):
+                config_chunks = group_contiguous(config_image, flash_write_size)
                 config_ok = verify_chunks(prog, config_chunks, "Configuration")
                 
             if flash_ok and config_ok:
@@ -456,9 +915,8 @@ def main():
                 
                 for i in range(0, len(data), 16):
                     line_data = data[i:i+16]
-                    hex_string = ' '.join([f'{w:04X}' for w in [
-                        int.from_bytes(line_data[j:j+2], 'big') for j in range(0, len(line_data), 2)
-                    ]])
+                    # Words arrive big-endian, so their hex text is the byte hex grouped in pairs.
+                    hex_string = line_data.hex(' ', 2).upper()
                     print(f"0x{current_addr:04X}: {hex_string}")
                     current_addr += len(line_data) // 2
                 
@@ -468,29 +926,45 @@ def main():
             filename = args.dump[0]
             print(f"Dumping Flash (0x0000 - 0x{rom_size:04X}) and Config to {filename}...")
             
-            dump_data = {}
+            # The whole flash is read straight into one buffer; blocks that fail keep 0x3FFF.
+            flash_buf = bytearray(b'\x3F\xFF' * rom_size)
+            flash_view = memoryview(flash_buf)
             
             read_chunk = 64
-            for addr in range(0, rom_size, read_chunk):
-                count = min(read_chunk, rom_size - addr)
-                print(f"\rReading Flash 0x{addr:04X}...", end='')
-                
-                block_bytes = prog.read_block(addr, count)
-                if block_bytes:
-                    for i in range(0, len(block_bytes), 2):
-                        word_val = int.from_bytes(block_bytes[i:i+2], 'big')
-                        dump_data[addr + (i//2)] = word_val
-                else:
-                    print(f" Error reading 0x{addr:04X}")
+            read_window = read_chunk * PIPELINE_DEPTH
+            # Words whose read failed; like the erased ones they are left out of the dump, but
+            # they are not counted as filtered.
+            words_missing = 0
+            for window_addr in range(0, rom_size, read_window):
+                print(f"\rReading Flash 0x{window_addr:04X}...", end='')
+                window_end = min(window_addr + read_window, rom_size)
+                requests = [
+                    (addr, min(read_chunk, window_end - addr))
+                    for addr in range(window_addr, window_end, read_chunk)
+                ]
+
+                received = prog.read_blocks_into(requests, flash_view[window_addr * 2:window_end * 2])
+                if received < (window_end - window_addr) * 2:
+                    failed_addr = window_addr + received // 2
+                    words_missing += window_end - failed_addr
+                    print(f" Error reading 0x{failed_addr - failed_addr % read_chunk:04X}")
+
+            # Dump image: flash words converted to the little-endian layout save_hex() expects.
+            image_size = max(rom_size, config_mem_end + 1)
+            dump_image = bytearray(b'\xFF\x3F' * image_size)
+            dump_present = bytearray(image_size)
+            dump_image[0:rom_size * 2:2], dump_image[1:rom_size * 2:2] = flash_buf[1::2], flash_buf[0::2]
 
             print("\nReading Config...", end=' ')
+            words_read = rom_size - words_missing
             if config_mem_start > 0 and config_mem_end >= config_mem_start:
                 cfg_len = (config_mem_end - config_mem_start) + 1
-                cfg_bytes = prog.read_block(config_mem_start, cfg_len)
-                if cfg_bytes:
-                    for i in range(0, len(cfg_bytes), 2):
-                        word_val = int.from_bytes(cfg_bytes[i:i+2], 'big')
-                        dump_data[config_mem_start + (i//2)] = word_val
+                cfg_buf = bytearray(cfg_len * 2)
+                if prog.read_block_into(config_mem_start, cfg_len, memoryview(cfg_buf)):
+                    cfg_lo, cfg_hi = config_mem_start * 2, (config_mem_end + 1) * 2
+                    dump_image[cfg_lo:cfg_hi:2], dump_image[cfg_lo + 1:cfg_hi:2] = cfg_buf[1::2], cfg_buf[0::2]
+                    dump_present[config_mem_start:config_mem_end + 1] = b'\x01' * cfg_len
+                    words_read += len(range(max(config_mem_start, rom_size), config_mem_end + 1))
                     print("Done.")
                 else:
                     print("Failed.")
@@ -498,15 +972,19 @@ def main():
                 print("Skipped.")
 
             print("Filtering empty memory (0x3FFF)...")
-            filtered_dump = {}
-            for addr, val in dump_data.items():
-                is_config = (config_mem_start <= addr <= config_mem_end)
-                if val != 0x3FFF or is_config:
-                    filtered_dump[addr] = val
+            # Keep every flash word except runs of 0x3FFF, found with one regex scan of the read buffer.
+            dump_present[:rom_size] = b'\x01' * rom_size
+            for match in ERASED_RUNS.finditer(flash_buf):
+                if match.group(1):
+                    dump_present[match.start() // 2:match.end() // 2] = bytes((match.end() - match.start()) // 2)
+            # Configuration words are always kept, even if blank.
+            keep_end = min(config_mem_end + 1, rom_size)
+            if config_mem_start < keep_end:
+                dump_present[config_mem_start:keep_end] = b'\x01' * (keep_end - config_mem_start)
             
             print(f"Saving to {filename}...")
-            save_hex(filename, filtered_dump)
-            print(f"Done. (Filtered {len(dump_data) - len(filtered_dump)} empty words)")
+            save_hex(filename, dump_image, dump_present)
+            print(f"Done. (Filtered {words_read - dump_present.count(1)} empty words)")
 
 
 